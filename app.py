@@ -7,13 +7,26 @@ GitHub: https://github.com/CoderXiaopang/Nginx-Proxy-Manager-Enhance
 """
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sqlite3
 import os
-from functools import wraps
+import sys
+import importlib.util
+import json
+import base64
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+import atexit
 from datetime import timedelta
 import threading
+import queue
 import time
 import socket
+import ipaddress
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
 
 # 尝试加载 .env 文件（可选依赖）
@@ -23,75 +36,407 @@ try:
 except ImportError:
     pass  # python-dotenv 未安装时跳过
 
+# fcntl 仅在类 Unix 系统可用，用于多 worker 部署时选举健康检查进程
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows 下不支持多进程部署，直接启动守护线程
+
+# 尝试使用 orjson 加速 JSON 编解码（可选依赖）
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson 未安装时使用标准库 json
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('npm_meta')
+
+SECRET_KEY_FILE = ".secret_key"
+SECRET_KEY_SIZE = 32
+
+
+def lock_file(path, blocking=True):
+    """
+    基于 fcntl.flock 的跨进程文件锁，成功时返回文件描述符（关闭即释放），
+    非阻塞模式下锁已被占用时返回 None；不支持 fcntl 的平台上总是视为拿到锁
+    """
+    if fcntl is None:
+        return -1
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def unlock_file(fd):
+    """释放 lock_file() 拿到的锁"""
+    if fd is not None and fd >= 0:
+        os.close(fd)
+
+
+def load_secret_key():
+    """
+    读取持久化的 session 密钥，不存在或内容无效时生成并保存（重启后 session 不失效）
+    多个 worker 同时启动时加锁串行化；密钥先写入临时文件再原子替换，不会留下半写入的文件
+    """
+    fd = lock_file(SECRET_KEY_FILE + ".lock")
+    try:
+        try:
+            with open(SECRET_KEY_FILE, 'rb') as f:
+                key = f.read()
+            if len(key) >= SECRET_KEY_SIZE:
+                return key
+            logger.warning("⚠️ session 密钥文件内容无效，重新生成")
+        except FileNotFoundError:
+            pass
+        key = os.urandom(SECRET_KEY_SIZE)
+        tmp = f"{SECRET_KEY_FILE}.{os.getpid()}.tmp"
+        tmp_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(tmp_fd, 'wb') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SECRET_KEY_FILE)
+        return key
+    finally:
+        unlock_file(fd)
+
+
 app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24).hex())
+app.secret_key = os.environ.get('SECRET_KEY') or load_secret_key()
 app.permanent_session_lifetime = timedelta(days=7)  # session 有效期 7 天
 
+if orjson is not None:
+    try:
+        from flask.json.provider import DefaultJSONProvider
+
+        class OrjsonProvider(DefaultJSONProvider):
+            """基于 orjson 的 JSON Provider，jsonify 直接输出 bytes"""
+
+            def dumps(self, obj, **kwargs):
+                return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+            def response(self, *args, **kwargs):
+                obj = self._prepare_response_obj(args, kwargs)
+                body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+                return self._app.response_class(body, mimetype=self.mimetype)
+
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        pass  # Flask < 2.2 不支持自定义 JSON Provider
+
 # NPM 配置 - 从环境变量读取
 NPM_HOST = os.environ.get('NPM_HOST', 'localhost:81')
 NPM_BASE_URL = f"http://{NPM_HOST}/api"
+_URL_TOKENS = f"{NPM_BASE_URL}/tokens"
+_URL_STREAMS = f"{NPM_BASE_URL}/nginx/streams"
 DB_NAME = "npm_meta.db"
+SCHEMA_VERSION = 2  # 数据库结构版本，记录在 PRAGMA user_version 中
+PORT = int(os.environ.get('PORT', 6789))
+DEBUG = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))  # gunicorn worker 进程数
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 16))  # 每个 gunicorn worker / waitress 的线程数
+_INIT_LOCK_FILE = DB_NAME + ".init.lock"  # 串行化各 worker 的数据库初始化
+_DAEMON_LOCK_FILE = DB_NAME + ".daemon.lock"  # 持有该锁的 worker 负责运行健康检查
+_CACHE_STAMP_FILE = DB_NAME + ".cache-stamp"  # 备注或转发列表写入时更新，通知其他 worker 缓存已失效
+_STREAMS_SNAPSHOT_FILE = DB_NAME + ".streams.json"  # 最近一次获取的转发列表，供任一 worker 中的健康检查降级使用
+
+# 非调试模式下不检查模板文件修改时间，静态文件允许浏览器缓存 1 天
+app.config.update(TEMPLATES_AUTO_RELOAD=DEBUG, SEND_FILE_MAX_AGE_DEFAULT=86400)
+
+# 常用 SQL 语句
+# 全部使用模块级常量，保证每次执行的 SQL 文本完全一致，命中连接的预编译语句缓存
+_SQL_UPSERT_STREAM = ("INSERT OR REPLACE INTO streams (npm_id, memo, doc_url, test_url, repo_url) "
+                      "VALUES (?, ?, ?, ?, ?)")
+_SQL_SELECT_STREAMS = "SELECT npm_id, memo, doc_url, test_url, repo_url FROM streams"
+_SQL_DELETE_STREAM = "DELETE FROM streams WHERE npm_id = ?"
+_SQL_UPSERT_HEALTH = "INSERT OR REPLACE INTO stream_health (npm_id, status, msg, last_check) VALUES (?, ?, ?, ?)"
+_SQL_SELECT_ALL_HEALTH = "SELECT npm_id, status, msg FROM stream_health"
+_SQL_DELETE_HEALTH = "DELETE FROM stream_health WHERE npm_id = ?"
+
+HEALTH_CHECK_INTERVAL = 60  # 后台健康检查周期（秒）
+HEALTH_CYCLE_TIMEOUT = HEALTH_CHECK_INTERVAL - 5  # 单轮检查的最长耗时，超时未完成的探测记为失败
+HEALTH_FLUSH_EVERY = 10  # 状态未变化时每隔多少轮才把检查时间写回数据库
 
 # 后台健康检查用的管理员账号（可选）
 NPM_ADMIN_EMAIL = os.environ.get('NPM_ADMIN_EMAIL', '')
 NPM_ADMIN_PASSWORD = os.environ.get('NPM_ADMIN_PASSWORD', '')
 
 
-# 全局变量：存储健康状态
-# {stream_id: {"status": "ok"|"error"|"unknown", "msg": "...", "last_check": timestamp}}
-STREAM_HEALTH_STATUS = {}
+# 各目标是否提供 /health 接口：{(ip, port): {"works": bool, "last": monotonic 时间}}
+# 探测失败的目标在 HEALTH_HTTP_RETRY_INTERVAL 秒内直接走 TCP 检查，不再等待 HTTP 超时
+HEALTH_HTTP_CAPABILITY = {}
+HEALTH_HTTP_RETRY_INTERVAL = 600
+
+# 健康检查 TCP 探测的 DNS 解析缓存，每小时清空一次
+DNS_CACHE_TTL = 3600
+_DNS_CACHE_RESET_AT = time.monotonic()
+
+# 备注缓存：{npm_id: {memo, doc_url, test_url, repo_url}}，None 表示需要重新加载
+# _MEMO_STAMP 为加载时 _CACHE_STAMP_FILE 的状态，与文件不一致说明其他进程写过数据
+_MEMO_CACHE = None
+_MEMO_STAMP = None
+_MEMO_LOCK = threading.RLock()
+# NPM 端口转发列表的短时缓存（写操作后失效）：{token: {"data", "by_port", "ts", "stamp"}}
+# by_port: {incoming_port: stream_id}，端口冲突检查直接查字典
+_STREAMS_CACHE = {}
+# 正在请求 NPM 的 {(token, stamp): Future}，同一 token 的并发未命中只请求一次
+_STREAMS_INFLIGHT = {}
+# 本进程最近一次成功获取的转发列表，变化时写入 _STREAMS_SNAPSHOT_FILE
+_STREAMS_LAST = None
+_STREAMS_LOCK = threading.Lock()  # 只保护上面的字典，不在持锁期间请求 NPM
+
+# 没有本地备注的转发使用的默认值
+_EMPTY_MEMO = {'memo': '', 'doc_url': '', 'test_url': '', 'repo_url': ''}
+# 既没有备注也尚未检查过的转发使用的默认值
+_EMPTY_META = {**_EMPTY_MEMO, 'health_status': 'unknown', 'health_msg': 'Pending...'}
+
+
+
+# NPM 请求共用的 HTTP 会话：复用 keep-alive 连接，避免每次调用都重新握手
+NPM_SESSION = requests.Session()
+_npm_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+)
+NPM_SESSION.mount('http://', _npm_adapter)
+NPM_SESSION.mount('https://', _npm_adapter)
 
+# 健康检查探测单独使用一个会话，探测连接不与 NPM API 请求争抢连接池；探测失败不重试
+HEALTH_SESSION = requests.Session()
+_health_adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=0)
+HEALTH_SESSION.mount('http://', _health_adapter)
+
+# 批量调用 NPM 时的并发线程池（线程数不超过连接池大小）
+NPM_EXECUTOR = ThreadPoolExecutor(max_workers=10, thread_name_prefix='npm')
+
+# 健康检查探测线程池：探测全是网络等待，多线程可以让各个超时相互重叠
+HEALTH_POOL = ThreadPoolExecutor(max_workers=64, thread_name_prefix='hc')
+
+# 异步 TCP 探测的 DNS 解析线程池：与探测线程池分开，解析不会排在 HTTP 探测后面
+DNS_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='dns')
 
 
 # ==================== 数据库初始化 ====================
+class DBPool:
+    """
+    SQLite 连接池:
+    启动时创建固定数量的长连接，使用时借出、用完归还，避免每次查询都重新打开数据库文件
+    readonly=True 时以只读方式打开（WAL 模式下读连接不会被写事务阻塞）
+    """
+
+    def __init__(self, path, size, readonly=False):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """打开一个长连接并设置 WAL 等性能参数"""
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False,
+                                   cached_statements=256)
+        else:
+            # 写事务直接以 BEGIN IMMEDIATE 开始，避免读锁升级写锁时的 SQLITE_BUSY
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level='IMMEDIATE',
+                                   cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA cache_size=-20000")  # 页缓存约 20MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA mmap_size=268435456")  # 读多写少，内存映射 256MB
+        return conn
+
+    def init(self):
+        """创建全部连接（重复调用无副作用）"""
+        with self._lock:
+            if self._pool is not None:
+                return
+            pool = queue.Queue(maxsize=self.size)
+            for _ in range(self.size):
+                pool.put(self._connect())
+            self._pool = pool
+
+    @contextmanager
+    def borrow(self):
+        """借出一个连接，退出时自动提交（异常时回滚）并归还"""
+        if self._pool is None:
+            self.init()
+        pool = self._pool
+        conn = pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            pool.put(conn)
+
+    def close(self):
+        """关闭所有空闲连接，写连接关闭前让 SQLite 更新查询统计信息"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        while not pool.empty():
+            conn = pool.get_nowait()
+            if not self.readonly:
+                try:
+                    conn.execute("PRAGMA optimize")
+                except sqlite3.Error:
+                    pass
+            conn.close()
+
+
+# 单个写连接 + 多个只读连接：后台健康检查写入时不阻塞页面读取
+db_writer = DBPool(DB_NAME, 1)
+db_reader = DBPool(DB_NAME, os.cpu_count() or 4, readonly=True)
+atexit.register(db_reader.close)
+atexit.register(db_writer.close)
+
+
 def init_db():
-    """初始化 SQLite 数据库"""
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute('''CREATE TABLE IF NOT EXISTS streams 
-                       (npm_id INTEGER PRIMARY KEY, 
-                        memo TEXT,
-                        doc_url TEXT,
-                        test_url TEXT,
-                        repo_url TEXT,
-                        health_status TEXT DEFAULT 'unknown',
-                        health_msg TEXT DEFAULT 'Pending...',
-                        health_last_check REAL)''')
-        
-        # 检查是否需要添加新字段（兼容旧数据库）
-        cursor = conn.execute("PRAGMA table_info(streams)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'health_status' not in columns:
-            conn.execute("ALTER TABLE streams ADD COLUMN health_status TEXT DEFAULT 'unknown'")
-        if 'health_msg' not in columns:
-            conn.execute("ALTER TABLE streams ADD COLUMN health_msg TEXT DEFAULT 'Pending...'")
-        if 'health_last_check' not in columns:
-            conn.execute("ALTER TABLE streams ADD COLUMN health_last_check REAL")
-        
-        print("✅ 数据库初始化完成")
+    """初始化 SQLite 数据库（通过 PRAGMA user_version 判断，已是最新结构时跳过建表和迁移）"""
+    db_writer.init()
+    with db_writer.borrow() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            logger.info("✅ 数据库已是最新结构")
+            return
+
+        # 迁移放在同一个写事务中：中途失败时整体回滚，user_version 不会前进；
+        # 拿到写锁后重新读取版本，避免与同时启动的其他进程重复迁移
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            logger.info("✅ 数据库已是最新结构")
+            return
+
+        if version < 1:
+            conn.execute('''CREATE TABLE IF NOT EXISTS streams 
+                           (npm_id INTEGER PRIMARY KEY, 
+                            memo TEXT,
+                            doc_url TEXT,
+                            test_url TEXT,
+                            repo_url TEXT,
+                            health_status TEXT DEFAULT 'unknown',
+                            health_msg TEXT DEFAULT 'Pending...',
+                            health_last_check REAL)''')
+            
+            # 检查是否需要添加新字段（兼容旧数据库）
+            cursor = conn.execute("PRAGMA table_info(streams)")
+            columns = [row[1] for row in cursor.fetchall()]
+            
+            if 'health_status' not in columns:
+                conn.execute("ALTER TABLE streams ADD COLUMN health_status TEXT DEFAULT 'unknown'")
+            if 'health_msg' not in columns:
+                conn.execute("ALTER TABLE streams ADD COLUMN health_msg TEXT DEFAULT 'Pending...'")
+            if 'health_last_check' not in columns:
+                conn.execute("ALTER TABLE streams ADD COLUMN health_last_check REAL")
+
+        if version < 2:
+            # 健康状态每分钟都会更新，单独放到窄表中，避免频繁改写备注表的页面
+            # streams 表中旧的 health_* 字段保留但不再使用
+            conn.execute('''CREATE TABLE IF NOT EXISTS stream_health 
+                           (npm_id INTEGER PRIMARY KEY, 
+                            status TEXT DEFAULT 'unknown',
+                            msg TEXT DEFAULT 'Pending...',
+                            last_check REAL)''')
+            conn.execute("""INSERT OR IGNORE INTO stream_health (npm_id, status, msg, last_check)
+                            SELECT npm_id, health_status, health_msg, health_last_check FROM streams
+                            WHERE health_last_check IS NOT NULL""")
+
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        logger.info("✅ 数据库初始化完成")
 
 
 
 # ==================== 装饰器：登录验证 ====================
+def token_expiry(token):
+    """读取 NPM JWT Token 中的过期时间 exp（只解析 payload，不校验签名），解析失败返回 None"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
 def login_required(f):
-    """装饰器：检查用户是否已登录"""
+    """装饰器：检查用户是否已登录，Token 已过期时直接拦截，不再请求 NPM"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'token' not in session:
             return redirect(url_for('login_page'))
+        token_exp = session.get('token_exp')
+        if token_exp and time.time() >= token_exp:
+            session.clear()
+            if request.path.startswith('/api/'):
+                return jsonify({"success": False, "error": "登录已过期，请重新登录"}), 401
+            return redirect(url_for('login_page'))
         return f(*args, **kwargs)
     return decorated_function
 
 
 # ==================== NPM API 封装 ====================
+def make_stream_payload(incoming_port, forward_ip, forward_port):
+    """构造创建/更新转发的 payload，只有端口和目标地址是可变字段"""
+    return {
+        "incoming_port": incoming_port,
+        "forwarding_host": forward_ip,
+        "forwarding_port": forward_port,
+        "tcp_forwarding": True,
+        "udp_forwarding": False,
+        "certificate_id": 0,  # 证书ID，0表示不使用
+        "meta": {}  # 元数据，默认为空对象
+    }
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+@lru_cache(maxsize=256)
+def auth_headers(token, json_body=False):
+    """构造 NPM 鉴权请求头（按 token 缓存，调用方不得修改返回的字典），json_body=True 时附带 Content-Type"""
+    headers = {"Authorization": f"Bearer {token}"}
+    if json_body:
+        headers.update(_JSON_HEADERS)
+    return headers
+
+
+def dump_json(obj):
+    """序列化请求体为 JSON bytes（优先使用 orjson）"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def parse_json(r):
+    """
+    直接从响应的原始 bytes 解析 JSON（优先使用 orjson）:
+    跳过 requests 先解码成 r.text 再解析的过程
+    """
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return json.loads(r.content)
+
+
 def npm_login(email, password):
     """调用 NPM 登录接口获取 Token"""
-    url = f"{NPM_BASE_URL}/tokens"
+    url = _URL_TOKENS
     payload = {"identity": email, "secret": password}
     try:
-        r = requests.post(url, json=payload, timeout=10)
+        r = NPM_SESSION.post(url, data=dump_json(payload), headers=_JSON_HEADERS, timeout=10)
         if r.status_code == 200:
-            return {"success": True, "token": r.json()['token']}
+            return {"success": True, "token": parse_json(r)['token']}
         else:
             return {"success": False, "error": f"登录失败: {r.json().get('message', '未知错误')}"}
     except Exception as e:
@@ -100,40 +445,33 @@ def npm_login(email, password):
 
 def npm_get_streams(token):
     """获取所有端口转发列表"""
-    url = f"{NPM_BASE_URL}/nginx/streams"
-    headers = {"Authorization": f"Bearer {token}"}
+    url = _URL_STREAMS
+    headers = auth_headers(token)
     try:
-        r = requests.get(url, headers=headers, timeout=10)
+        r = NPM_SESSION.get(url, headers=headers, timeout=10)
         if r.status_code == 200:
-            return {"success": True, "data": r.json()}
+            return {"success": True, "data": parse_json(r)}
         else:
-            return {"success": False, "error": "获取列表失败"}
+            return {"success": False, "error": "获取列表失败", "status_code": r.status_code}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
 def npm_create_stream(token, incoming_port, forward_ip, forward_port):
-    """创建端口转发"""
-    url = f"{NPM_BASE_URL}/nginx/streams"
-    headers = {"Authorization": f"Bearer {token}"}
-    payload = {
-        "incoming_port": int(incoming_port),
-        "forwarding_host": forward_ip,
-        "forwarding_port": int(forward_port),
-        "tcp_forwarding": True,
-        "udp_forwarding": False,
-        "certificate_id": 0,  # 新增：证书ID，0表示不使用
-        "meta": {}  # 新增：元数据，默认为空对象
-    }
+    """创建端口转发（端口参数需已转换为 int）"""
+    url = _URL_STREAMS
+    headers = auth_headers(token, json_body=True)
+    payload = make_stream_payload(incoming_port, forward_ip, forward_port)
     try:
-        print(f"🔌 发送请求到 NPM: {url}")
-        print(f"📦 请求payload: {payload}")
-        r = requests.post(url, json=payload, headers=headers, timeout=10)
-        print(f"📡 NPM响应状态码: {r.status_code}")
-        print(f"📡 NPM响应内容: {r.text}")
+        logger.debug("🔌 发送请求到 NPM: %s", url)
+        logger.debug("📦 请求payload: %s", payload)
+        r = NPM_SESSION.post(url, data=dump_json(payload), headers=headers, timeout=10)
+        logger.debug("📡 NPM响应状态码: %d", r.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📡 NPM响应内容: %s", r.text)
 
         if r.status_code in [200, 201]:
-            return {"success": True, "data": r.json()}
+            return {"success": True, "data": parse_json(r)}
         else:
             # 尝试解析错误信息
             try:
@@ -147,27 +485,20 @@ def npm_create_stream(token, incoming_port, forward_ip, forward_port):
 
 
 def npm_update_stream(token, stream_id, incoming_port, forward_ip, forward_port):
-    """更新端口转发"""
-    url = f"{NPM_BASE_URL}/nginx/streams/{stream_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    payload = {
-        "incoming_port": int(incoming_port),
-        "forwarding_host": forward_ip,
-        "forwarding_port": int(forward_port),
-        "tcp_forwarding": True,
-        "udp_forwarding": False,
-        "certificate_id": 0,
-        "meta": {}
-    }
+    """更新端口转发（端口参数需已转换为 int）"""
+    url = f"{_URL_STREAMS}/{stream_id}"
+    headers = auth_headers(token, json_body=True)
+    payload = make_stream_payload(incoming_port, forward_ip, forward_port)
     try:
-        print(f"✏️ 更新 Stream ID: {stream_id}")
-        print(f"📦 更新 payload: {payload}")
-        r = requests.put(url, json=payload, headers=headers, timeout=10)
-        print(f"📡 更新响应状态码: {r.status_code}")
-        print(f"📡 更新响应内容: {r.text}")
+        logger.debug("✏️ 更新 Stream ID: %s", stream_id)
+        logger.debug("📦 更新 payload: %s", payload)
+        r = NPM_SESSION.put(url, data=dump_json(payload), headers=headers, timeout=10)
+        logger.debug("📡 更新响应状态码: %d", r.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📡 更新响应内容: %s", r.text)
 
         if r.status_code in [200, 201]:
-            return {"success": True, "data": r.json()}
+            return {"success": True, "data": parse_json(r)}
         else:
             try:
                 error_detail = r.json()
@@ -180,48 +511,19 @@ def npm_update_stream(token, stream_id, incoming_port, forward_ip, forward_port)
 
 
 def npm_toggle_stream(token, stream_id, enabled):
-    """切换端口转发启用状态"""
-    url = f"{NPM_BASE_URL}/nginx/streams/{stream_id}"
-    headers = {"Authorization": f"Bearer {token}"}
+    """切换端口转发启用状态（NPM 的 enable/disable 接口不需要请求体，无需先获取当前数据）"""
+    url = f"{_URL_STREAMS}/{stream_id}/{'enable' if enabled else 'disable'}"
+    headers = auth_headers(token)
     
     try:
-        # 先获取当前 stream 信息
-        r = requests.get(url, headers=headers, timeout=10)
-        if r.status_code != 200:
-            return {"success": False, "error": "获取转发信息失败"}
-        
-        current_data = r.json()
-        print(f"📋 当前 stream 数据: {current_data}")
-        
-        # 构建更新 payload，只包含 NPM 允许的字段
-        payload = {
-            "incoming_port": current_data['incoming_port'],
-            "forwarding_host": current_data['forwarding_host'],
-            "forwarding_port": current_data['forwarding_port'],
-            "tcp_forwarding": current_data.get('tcp_forwarding', True),
-            "udp_forwarding": current_data.get('udp_forwarding', False),
-            "certificate_id": current_data.get('certificate_id', 0),
-            "meta": current_data.get('meta', {})
-        }
-        
-        print(f"🔄 切换 Stream {stream_id} 状态: enabled={enabled}")
-        print(f"📦 发送 payload: {payload}")
-        
-        # 使用 NPM 的 enable/disable 专用接口（如果有的话）
-        # 或者用 PUT 更新完整数据
-        if enabled:
-            # 启用：发送 POST 到 enable 接口
-            enable_url = f"{NPM_BASE_URL}/nginx/streams/{stream_id}/enable"
-            r = requests.post(enable_url, headers=headers, timeout=10)
-        else:
-            # 禁用：发送 POST 到 disable 接口
-            disable_url = f"{NPM_BASE_URL}/nginx/streams/{stream_id}/disable"
-            r = requests.post(disable_url, headers=headers, timeout=10)
+        logger.debug("🔄 切换 Stream %s 状态: enabled=%s", stream_id, enabled)
+        r = NPM_SESSION.post(url, headers=headers, timeout=10)
         
-        print(f"📡 切换响应: {r.status_code} - {r.text}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📡 切换响应: %d - %s", r.status_code, r.text)
 
         if r.status_code in [200, 201]:
-            return {"success": True, "data": r.json() if r.text else {}}
+            return {"success": True, "data": parse_json(r) if r.content else {}}
         else:
             try:
                 error_detail = r.json()
@@ -235,16 +537,17 @@ def npm_toggle_stream(token, stream_id, enabled):
 
 def npm_delete_stream(token, stream_id):
     """删除端口转发"""
-    url = f"{NPM_BASE_URL}/nginx/streams/{stream_id}"
-    headers = {"Authorization": f"Bearer {token}"}
+    url = f"{_URL_STREAMS}/{stream_id}"
+    headers = auth_headers(token)
     try:
-        print(f"🗑️ 正在删除 Stream ID: {stream_id}")
-        print(f"🔗 请求URL: {url}")
+        logger.debug("🗑️ 正在删除 Stream ID: %s", stream_id)
+        logger.debug("🔗 请求URL: %s", url)
 
-        r = requests.delete(url, headers=headers, timeout=10)
+        r = NPM_SESSION.delete(url, headers=headers, timeout=10)
 
-        print(f"📡 删除响应状态码: {r.status_code}")
-        print(f"📡 删除响应内容: {r.text}")
+        logger.debug("📡 删除响应状态码: %d", r.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📡 删除响应内容: %s", r.text)
 
         if r.status_code == 200:
             # NPM 返回的是布尔值 true
@@ -269,75 +572,331 @@ def npm_delete_stream(token, stream_id):
     except Exception as e:
         return {"success": False, "error": f"系统错误: {str(e)}"}
 
-        return {"success": False, "error": f"系统错误: {str(e)}"}
+
+def cache_stamp():
+    """读取跨进程缓存失效标记（修改时间 + 大小），文件不存在时返回 None"""
+    try:
+        st = os.stat(_CACHE_STAMP_FILE)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def bump_cache_stamp():
+    """更新跨进程缓存失效标记，其他 worker 下次读取缓存时发现变化并重新加载"""
+    # 追加一个字节：即使文件系统时间戳精度不够，大小也一定会变化
+    with open(_CACHE_STAMP_FILE, 'ab') as f:
+        f.write(b'.')
+        if f.tell() >= 4096:
+            f.truncate(0)
+
+
+def get_streams_cached(token, max_age=5.0):
+    """
+    获取端口转发列表：同一 token 在 max_age 秒内复用上次结果，避免重复请求 NPM
+    任一 worker 写入过转发规则时（cache_stamp 变化）立即重新获取
+    成功时额外返回 by_port 索引 {incoming_port: stream_id}
+    """
+    global _STREAMS_LAST
+    stamp = cache_stamp()
+    key = (token, stamp)
+    with _STREAMS_LOCK:
+        entry = _STREAMS_CACHE.get(token)
+        if entry and entry['stamp'] == stamp and time.monotonic() - entry['ts'] < max_age:
+            return {"success": True, "data": entry['data'], "by_port": entry['by_port']}
+        future = _STREAMS_INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = _STREAMS_INFLIGHT[key] = Future()
+
+    # 其他线程正在为同一 token 请求 NPM，直接等待它的结果
+    if not owner:
+        return future.result()
+
+    try:
+        result = npm_get_streams(token)
+        if result['success']:
+            by_port = {}
+            for stream in result['data']:
+                by_port.setdefault(stream['incoming_port'], stream['id'])
+            result['by_port'] = by_port
+            now = time.monotonic()
+            with _STREAMS_LOCK:
+                # 顺便清理已过期的其他 token，避免字典无限增长
+                for t in [t for t, e in _STREAMS_CACHE.items() if now - e['ts'] >= max_age]:
+                    del _STREAMS_CACHE[t]
+                _STREAMS_CACHE[token] = {"data": result['data'], "by_port": by_port, "ts": now, "stamp": stamp}
+                changed = result['data'] != _STREAMS_LAST
+                _STREAMS_LAST = result['data']
+            if changed:
+                save_streams_snapshot(result['data'])
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _STREAMS_LOCK:
+            _STREAMS_INFLIGHT.pop(key, None)
+
+
+def save_streams_snapshot(streams):
+    """
+    把转发列表原子写入共享快照文件：多 worker 部署时运行健康检查的 worker
+    未必处理过页面请求，未配置管理员账号时从这里读取要检查的转发
+    """
+    tmp = f"{_STREAMS_SNAPSHOT_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dump_json(streams))
+        os.replace(tmp, _STREAMS_SNAPSHOT_FILE)
+    except OSError as e:
+        logger.warning("⚠️ 写入转发列表快照失败: %s", e)
+
+
+def load_streams_snapshot():
+    """读取共享快照文件中的转发列表，不存在或损坏时返回 None"""
+    try:
+        with open(_STREAMS_SNAPSHOT_FILE, 'rb') as f:
+            data = f.read()
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+def invalidate_streams_cache():
+    """使端口转发列表缓存失效（包括其他 worker 进程中的缓存，保留数据供后台健康检查降级使用）"""
+    with _STREAMS_LOCK:
+        _STREAMS_CACHE.clear()
+        bump_cache_stamp()
+
+
+def npm_map(func, token, stream_ids):
+    """
+    并发地对多个 stream 调用同一个 npm_* 函数:
+    各请求的网络等待相互重叠，N 次往返耗时接近 1 次
+    返回 {stream_id: result}
+    """
+    futures = {sid: NPM_EXECUTOR.submit(func, token, sid) for sid in stream_ids}
+    results = {}
+    for sid, fut in futures.items():
+        try:
+            results[sid] = fut.result()
+        except Exception as e:
+            results[sid] = {"success": False, "error": str(e)}
+    return results
+
+
+class NpmToken:
+    """
+    后台使用的 NPM 管理员 Token:
+    首次使用或临近过期时自动登录，NPM 返回 401 时作废并重新登录
+    """
+
+    def __init__(self, email, password):
+        self.email = email
+        self.password = password
+        self._token = None
+        self._exp = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """返回可用的 Token，登录失败时返回 None"""
+        with self._lock:
+            if self._token and self._exp and time.time() >= self._exp - 60:
+                self._token = None  # 即将过期，提前重新登录
+            if self._token is None:
+                logger.info("🔑 使用管理员账号登录 NPM...")
+                result = npm_login(self.email, self.password)
+                if result['success']:
+                    self._token = result['token']
+                    self._exp = token_expiry(self._token)
+                    logger.info("✅ 后台管理员登录成功")
+                else:
+                    logger.error("❌ 后台管理员登录失败: %s", result.get('error'))
+            return self._token
+
+    def invalidate(self):
+        """作废当前 Token，下次使用时重新登录"""
+        with self._lock:
+            self._token = None
+
+    def call(self, func, *args):
+        """用当前 Token 调用 npm_* 函数，遇到 401 时重新登录并重试一次"""
+        result = {"success": False, "error": "后台管理员登录失败"}
+        for _ in range(2):
+            token = self.get()
+            if token is None:
+                break
+            result = func(token, *args)
+            if result.get('status_code') != 401:
+                break
+            self.invalidate()
+        return result
 
 
 # ==================== 健康检查逻辑 ====================
+@lru_cache(maxsize=1024)
+def _resolve_host_cached(host):
+    return socket.gethostbyname(host)
+
+
+def is_ip_address(host):
+    """host 是否为 IP 地址字面量（无需 DNS 解析）"""
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def resolve_host(host):
+    """解析主机名（结果缓存 DNS_CACHE_TTL 秒，IP 地址直接返回）"""
+    global _DNS_CACHE_RESET_AT
+    if is_ip_address(host):
+        return host
+    now = time.monotonic()
+    if now - _DNS_CACHE_RESET_AT > DNS_CACHE_TTL:
+        _resolve_host_cached.cache_clear()
+        _DNS_CACHE_RESET_AT = now
+    return _resolve_host_cached(host)
+
+
+def should_probe_http(forward_ip, forward_port):
+    """目标最近 HEALTH_HTTP_RETRY_INTERVAL 秒内探测 /health 失败过时返回 False"""
+    capability = HEALTH_HTTP_CAPABILITY.get((forward_ip, forward_port))
+    return (capability is None or capability['works']
+            or time.monotonic() - capability['last'] >= HEALTH_HTTP_RETRY_INTERVAL)
+
+
+def tcp_error_result(e):
+    """把 TCP 探测的异常转换为健康检查结果"""
+    if isinstance(e, socket.gaierror):
+        return {"status": "error", "msg": f"DNS error: {str(e)}"}
+    if isinstance(e, (socket.timeout, asyncio.TimeoutError)):
+        return {"status": "error", "msg": "Check error: timed out"}
+    if isinstance(e, OSError) and e.errno:
+        return {"status": "error", "msg": f"TCP error code: {e.errno}"}
+    return {"status": "error", "msg": f"Check error: {str(e)}"}
+
+
 def check_stream_connectivity(forward_ip, forward_port):
     """
     检查连通性:
-    1. 优先尝试 http://ip:port/health
+    1. 优先尝试 http://ip:port/health（最近 10 分钟内探测失败过的目标跳过这一步）
     2. 失败则尝试简单的 TCP 连接
     """
     # 1. 尝试 /health 接口
-    try:
-        url = f"http://{forward_ip}:{forward_port}/health"
-        r = requests.get(url, timeout=3)
-        if r.status_code == 200:
-            try:
-                # 尝试解析 JSON
-                data = r.json()
-                if data.get("status") == "ok":
-                    return {"status": "ok", "msg": "Health check ok"}
-            except:
-                pass
-            # 即使没有 status: ok，只要 200 也算通
-            return {"status": "ok", "msg": f"HTTP {r.status_code}"}
-    except:
-        # HTTP 失败，忽略，尝试 TCP
-        pass
+    if should_probe_http(forward_ip, forward_port):
+        key = (forward_ip, forward_port)
+        try:
+            url = f"http://{forward_ip}:{forward_port}/health"
+            r = HEALTH_SESSION.get(url, timeout=1)
+            if r.status_code == 200:
+                HEALTH_HTTP_CAPABILITY[key] = {"works": True, "last": time.monotonic()}
+                try:
+                    # 尝试解析 JSON
+                    data = r.json()
+                    if data.get("status") == "ok":
+                        return {"status": "ok", "msg": "Health check ok"}
+                except:
+                    pass
+                # 即使没有 status: ok，只要 200 也算通
+                return {"status": "ok", "msg": f"HTTP {r.status_code}"}
+        except:
+            # HTTP 失败，忽略，尝试 TCP
+            pass
+        HEALTH_HTTP_CAPABILITY[key] = {"works": False, "last": time.monotonic()}
 
     # 2. 尝试 TCP 连接 (curl host:port 这里简化为 connect 成功即可)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        result = sock.connect_ex((forward_ip, int(forward_port)))
-        sock.close()
-        
-        if result == 0:
+        address = (resolve_host(forward_ip), int(forward_port))
+        with socket.create_connection(address, timeout=3):
             return {"status": "ok", "msg": "TCP connect success"}
-        else:
-            return {"status": "error", "msg": f"TCP error code: {result}"}
     except Exception as e:
-        return {"status": "error", "msg": f"Check error: {str(e)}"}
+        return tcp_error_result(e)
+
+
+def check_tcp_many(targets, timeout=3, deadline=None):
+    """
+    在单个事件循环中并发检查多个目标的 TCP 连通性（连接本身不占用线程池）
+    targets: [(key, ip, port), ...]，返回 {key: result}
+    timeout 同时限制单个目标的 DNS 解析和连接；到 deadline（time.monotonic 时间）
+    仍未完成的目标记为 probe timeout
+    """
+    async def connect(host, port):
+        # IP 地址无需解析；域名放到 DNS_POOL 解析（不用默认线程池：卡住的解析线程会阻塞 asyncio.run 退出）
+        if is_ip_address(host):
+            address = host
+        else:
+            address = await asyncio.get_running_loop().run_in_executor(DNS_POOL, resolve_host, host)
+        _, writer = await asyncio.open_connection(address, int(port))
+        writer.close()
+
+    async def probe(host, port):
+        try:
+            await asyncio.wait_for(connect(host, port), timeout)
+            return {"status": "ok", "msg": "TCP connect success"}
+        except Exception as e:
+            return tcp_error_result(e)
+
+    async def probe_all():
+        tasks = [asyncio.ensure_future(probe(ip, port)) for _, ip, port in targets]
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        await asyncio.wait(tasks, timeout=remaining)
+        results = []
+        for task in tasks:
+            if task.done():
+                results.append(task.result())
+            else:
+                task.cancel()
+                results.append({"status": "error", "msg": "probe timeout"})
+        return results
+
+    if not targets:
+        return {}
+    results = asyncio.run(probe_all())
+    return {key: res for (key, _, _), res in zip(targets, results)}
+
+
+def save_health_status_many(rows):
+    """
+    批量保存健康状态到数据库（单个事务，只提交一次）
+    rows: [(npm_id, status, msg), ...]
+    """
+    now = time.time()
+    with db_writer.borrow() as conn:
+        conn.executemany(_SQL_UPSERT_HEALTH, [(npm_id, status, msg, now) for npm_id, status, msg in rows])
 
 
 def save_health_status(npm_id, status, msg):
-    """保存健康状态到数据库"""
-    with sqlite3.connect(DB_NAME) as conn:
-        # 先确保记录存在
-        conn.execute("INSERT OR IGNORE INTO streams (npm_id) VALUES (?)", (npm_id,))
-        # 更新健康状态
-        conn.execute("""UPDATE streams 
-                       SET health_status = ?, health_msg = ?, health_last_check = ?
-                       WHERE npm_id = ?""",
-                     (status, msg, time.time(), npm_id))
-
-
-def get_health_status(npm_id):
-    """从数据库获取健康状态"""
-    with sqlite3.connect(DB_NAME) as conn:
-        result = conn.execute(
-            "SELECT health_status, health_msg, health_last_check FROM streams WHERE npm_id = ?",
-            (npm_id,)
-        ).fetchone()
-        if result:
-            return {
-                'status': result[0] or 'unknown',
-                'msg': result[1] or 'Pending...',
-                'last_check': result[2]
-            }
-        return {'status': 'unknown', 'msg': 'Pending...', 'last_check': None}
+    """保存单个健康状态到数据库"""
+    save_health_status_many([(npm_id, status, msg)])
+
+
+def get_all_health_status():
+    """从数据库获取所有健康状态（返回字典 {npm_id: (status, msg)}）"""
+    with db_reader.borrow() as conn:
+        rows = conn.execute(_SQL_SELECT_ALL_HEALTH).fetchall()
+    return {row[0]: (row[1] or 'unknown', row[2] or 'Pending...') for row in rows}
+
+
+def get_all_stream_meta():
+    """
+    获取所有转发的本地数据（备注、URL、健康状态），返回字典:
+    {npm_id: {memo, doc_url, test_url, repo_url, health_status, health_msg}}
+    备注来自内存缓存，健康状态只需一次查询
+    """
+    meta = {npm_id: {**memo, 'health_status': 'unknown', 'health_msg': 'Pending...'}
+            for npm_id, memo in get_all_memos().items()}
+    for npm_id, (status, msg) in get_all_health_status().items():
+        item = meta.get(npm_id)
+        if item is None:
+            item = meta[npm_id] = dict(_EMPTY_MEMO)
+        item['health_status'] = status
+        item['health_msg'] = msg
+    return meta
 
 
 def check_single_stream_health(stream_id, ip, port):
@@ -349,125 +908,170 @@ def check_single_stream_health(stream_id, ip, port):
         res = check_stream_connectivity(ip, port)
         # 保存到数据库
         save_health_status(stream_id, res['status'], res['msg'])
-        # 同时更新内存缓存
-        STREAM_HEALTH_STATUS[stream_id] = {
-            "status": res['status'],
-            "msg": res['msg'],
-            "last_check": time.time()
-        }
-        print(f"✅ 立即检查流 {stream_id} 的健康状态: {res['status']}")
+        logger.debug("✅ 立即检查流 %s 的健康状态: %s", stream_id, res['status'])
     except Exception as e:
-        print(f"❌ 检查流 {stream_id} 失败: {e}")
+        logger.error("❌ 检查流 %s 失败: %s", stream_id, e)
 
 
 def health_check_daemon(app):
     """后台线程：定时检查所有转发的健康状态"""
     with app.app_context():
-        print("🚑 健康检查线程已启动...")
+        logger.info("🚑 健康检查线程已启动...")
         
-        # 尝试获取后台管理员 token
-        bg_token = None
+        # 后台管理员 token（配置了账号时使用，过期或失效时自动重新登录）
+        admin_token = None
         if NPM_ADMIN_EMAIL and NPM_ADMIN_PASSWORD:
-            print("🔑 使用管理员账号登录 NPM...")
-            login_result = npm_login(NPM_ADMIN_EMAIL, NPM_ADMIN_PASSWORD)
-            if login_result['success']:
-                bg_token = login_result['token']
-                print("✅ 后台管理员登录成功")
-            else:
-                print(f"❌ 后台管理员登录失败: {login_result.get('error')}")
+            admin_token = NpmToken(NPM_ADMIN_EMAIL, NPM_ADMIN_PASSWORD)
+            admin_token.get()
         
+        cycle = 0
+
         # 🔥 立即执行第一次检查
         def run_health_check():
+            nonlocal cycle
+            cycle += 1
+            deadline = time.monotonic() + HEALTH_CYCLE_TIMEOUT
             try:
                 # 优先使用后台 token 获取最新数据
                 streams_to_check = []
                 
-                if bg_token:
-                    # 使用后台管理员账号获取流列表
-                    result = npm_get_streams(bg_token)
-                    if result['success']:
-                        streams_to_check = result['data']
-                        print(f"📡 从 NPM 获取到 {len(streams_to_check)} 个流")
+                # 使用后台管理员账号获取流列表
+                result = admin_token.call(npm_get_streams) if admin_token else None
+                if result and result['success']:
+                    streams_to_check = result['data']
+                    logger.debug("📡 从 NPM 获取到 %d 个流", len(streams_to_check))
                 else:
-                    # 降级：使用缓存的数据
-                    global CACHED_STREAMS
-                    if 'CACHED_STREAMS' in globals() and CACHED_STREAMS:
-                        streams_to_check = CACHED_STREAMS
-                        print(f"📦 使用缓存数据，共 {len(streams_to_check)} 个流")
+                    # 降级：使用任一 worker 处理页面请求时保存的转发列表快照
+                    streams_to_check = load_streams_snapshot() or []
+                    if streams_to_check:
+                        logger.debug("📦 使用缓存数据，共 %d 个流", len(streams_to_check))
                 
                 if not streams_to_check:
-                    print("⚠️  没有可检查的流（请配置 NPM_ADMIN_EMAIL 和 NPM_ADMIN_PASSWORD，或等待用户访问页面）")
+                    logger.warning("⚠️  没有可检查的流（请配置 NPM_ADMIN_EMAIL 和 NPM_ADMIN_PASSWORD，或等待用户访问页面）")
                     return
                 
-                # 执行健康检查
-                checked_count = 0
-                for stream in streams_to_check:
-                    sid = stream.get('id')
-                    ip = stream.get('forwarding_host')
-                    port = stream.get('forwarding_port')
-                    
-                    if ip and port:
-                        res = check_stream_connectivity(ip, port)
-                        # 保存到数据库
-                        save_health_status(sid, res['status'], res['msg'])
-                        # 同时更新内存缓存（可选，用于快速访问）
-                        STREAM_HEALTH_STATUS[sid] = {
-                            "status": res['status'],
-                            "msg": res['msg'],
-                            "last_check": time.time()
-                        }
-                        checked_count += 1
+                # 并发执行健康检查，结果汇总后一次性写入数据库:
+                # 可能提供 /health 的目标交给线程池做 HTTP + TCP 检查，
+                # 已知没有 /health 的目标直接在事件循环中并发做 TCP 检查
+                futures = {}
+                tcp_targets = []
+                for s in streams_to_check:
+                    ip = s.get('forwarding_host')
+                    port = s.get('forwarding_port')
+                    if not (ip and port):
+                        continue
+                    if should_probe_http(ip, port):
+                        futures[HEALTH_POOL.submit(check_stream_connectivity, ip, port)] = s.get('id')
+                    else:
+                        tcp_targets.append((s.get('id'), ip, port))
+
+                updates = []
+                if tcp_targets:
+                    for sid, res in check_tcp_many(tcp_targets, deadline=deadline).items():
+                        updates.append((sid, res['status'], res['msg']))
+                # 整轮检查限时完成，个别目标卡住时不拖慢下一轮
+                done, pending = wait(futures, timeout=max(0, deadline - time.monotonic()))
+                for fut in done:
+                    res = fut.result()
+                    updates.append((futures[fut], res['status'], res['msg']))
+                for fut in pending:
+                    fut.cancel()
+                    updates.append((futures[fut], "error", "probe timeout"))
+                if pending:
+                    logger.warning("⏱️ %d 个服务健康检查超时", len(pending))
+
+                # 只写入状态有变化的行，稳定状态下几乎不产生 WAL 写入；以数据库中的状态为准比较
+                # （其他 worker 可能刚写过）。每 HEALTH_FLUSH_EVERY 轮全部写回一次，last_check 最多滞后这么多轮
+                flush_all = cycle % HEALTH_FLUSH_EVERY == 1
+                saved = get_all_health_status() if not flush_all else {}
+                changed = []
+                for sid, status, msg in updates:
+                    if flush_all or saved.get(sid) != (status, msg):
+                        changed.append((sid, status, msg))
+                if changed:
+                    save_health_status_many(changed)
                 
-                print(f"✅ 健康检查完成，检查了 {checked_count} 个服务")
+                logger.info("✅ 健康检查完成，检查了 %d 个服务，%d 个状态写入数据库", len(updates), len(changed))
             except Exception as e:
-                print(f"❌ Health check error: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("❌ Health check error: %s", e)
         
         # 等待2秒让应用完全启动
         time.sleep(2)
-        print("🔍 开始首次健康检查...")
+        logger.info("🔍 开始首次健康检查...")
         run_health_check()
         
-        # 定时检查
+        # 定时检查：按单调时钟对齐到固定周期，检查本身的耗时不会累加到间隔上
+        next_run = time.monotonic()
         while True:
-            time.sleep(60)  # 每隔 1 分钟
-            print("🔄 执行定时健康检查...")
+            next_run += HEALTH_CHECK_INTERVAL
+            sleep_for = next_run - time.monotonic()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+            else:
+                # 上一轮超时，跳过错过的周期，立即开始下一轮
+                next_run = time.monotonic()
+            logger.debug("🔄 执行定时健康检查...")
             run_health_check()
 
 
 
 
-def save_memo(npm_id, memo, doc_url='', test_url='', repo_url=''):
-    """保存备注和URL到数据库"""
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("""INSERT OR REPLACE INTO streams 
-                       (npm_id, memo, doc_url, test_url, repo_url) 
-                       VALUES (?, ?, ?, ?, ?)""",
-                     (npm_id, memo, doc_url, test_url, repo_url))
+def invalidate_memo_cache():
+    """使备注缓存失效（包括其他 worker 进程中的缓存），下次读取时重新查询数据库"""
+    global _MEMO_CACHE
+    with _MEMO_LOCK:
+        _MEMO_CACHE = None
+        bump_cache_stamp()
 
 
-def get_memo(npm_id):
-    """获取单个备注"""
-    with sqlite3.connect(DB_NAME) as conn:
-        result = conn.execute("SELECT memo FROM streams WHERE npm_id = ?", (npm_id,)).fetchone()
-        return result[0] if result else None
+def save_memo(npm_id, memo, doc_url='', test_url='', repo_url=''):
+    """保存备注和URL到数据库"""
+    with db_writer.borrow() as conn:
+        conn.execute(_SQL_UPSERT_STREAM, (npm_id, memo, doc_url, test_url, repo_url))
+    invalidate_memo_cache()
 
 
 def get_all_memos():
-    """获取所有备注和URL（返回字典）"""
-    with sqlite3.connect(DB_NAME) as conn:
-        rows = conn.execute("SELECT npm_id, memo, doc_url, test_url, repo_url FROM streams").fetchall()
-        return {row[0]: {'memo': row[1], 'doc_url': row[2], 'test_url': row[3], 'repo_url': row[4]} for row in rows}
+    """获取所有备注和URL（返回字典，结果缓存在内存中，任一进程写入时失效）"""
+    global _MEMO_CACHE, _MEMO_STAMP
+    stamp = cache_stamp()
+    memos = _MEMO_CACHE
+    if memos is not None and stamp == _MEMO_STAMP:
+        return memos
+    with _MEMO_LOCK:
+        if _MEMO_CACHE is None or stamp != _MEMO_STAMP:
+            # 先读标记再查询：查询期间发生的写入会在下次读取时被发现
+            with db_reader.borrow() as conn:
+                rows = conn.execute(_SQL_SELECT_STREAMS).fetchall()
+            _MEMO_CACHE = {row[0]: {'memo': row[1], 'doc_url': row[2], 'test_url': row[3], 'repo_url': row[4]} for row in rows}
+            _MEMO_STAMP = stamp
+        return _MEMO_CACHE
 
 
 def delete_memo(npm_id):
-    """删除备注"""
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("DELETE FROM streams WHERE npm_id = ?", (npm_id,))
+    """删除备注及健康状态"""
+    with db_writer.borrow() as conn:
+        conn.execute(_SQL_DELETE_STREAM, (npm_id,))
+        conn.execute(_SQL_DELETE_HEALTH, (npm_id,))
+    invalidate_memo_cache()
+
+
+def delete_memos_bulk(npm_ids):
+    """批量删除备注及健康状态（单个事务内 executemany）"""
+    params = [(i,) for i in npm_ids]
+    with db_writer.borrow() as conn:
+        conn.executemany(_SQL_DELETE_STREAM, params)
+        conn.executemany(_SQL_DELETE_HEALTH, params)
+    invalidate_memo_cache()
 
 
 # ==================== 路由：页面 ====================
+def warm_templates():
+    """预先加载并编译页面模板到 Jinja 缓存"""
+    for name in ('loginh.html', 'memang.html'):
+        app.jinja_env.get_template(name)
+
+
 @app.route('/')
 def login_page():
     """登录页面"""
@@ -482,6 +1086,26 @@ def manage_page():
 
 
 # ==================== 路由：API ====================
+def parse_stream_params(data):
+    """
+    解析并校验转发参数，返回 (incoming_port, forward_ip, forward_port)
+    参数缺失或端口不合法时抛出 ValueError（消息可直接返回给前端）
+    """
+    try:
+        incoming_port = int(data['incoming_port'])
+        forward_port = int(data['forward_port'])
+        forward_ip = data['forward_ip']
+    except (KeyError, TypeError):
+        raise ValueError("参数不完整") from None
+    except ValueError:
+        raise ValueError("端口号必须在 1-65535 之间") from None
+    if not forward_ip:
+        raise ValueError("参数不完整")
+    if not (1 <= incoming_port <= 65535 and 1 <= forward_port <= 65535):
+        raise ValueError("端口号必须在 1-65535 之间")
+    return incoming_port, forward_ip, forward_port
+
+
 @app.route('/api/login', methods=['POST'])
 def api_login():
     """登录接口 - 支持 JSON 和表单提交两种方式"""
@@ -511,6 +1135,7 @@ def api_login():
         session.permanent = remember_me  # 是否记住登录
         session['token'] = result['token']
         session['email'] = email
+        session['token_exp'] = token_expiry(result['token'])
 
         if is_form_submit:
             # 表单提交：重定向到管理页面（触发浏览器密码保存提示）
@@ -536,35 +1161,24 @@ def api_get_streams():
     """获取端口转发列表（带备注）"""
     token = session.get('token')
     
-    # 从 NPM 获取数据
-    npm_result = npm_get_streams(token)
+    # 从 NPM 获取数据（短时缓存，同时供后台线程降级使用）
+    npm_result = get_streams_cached(token)
     if not npm_result['success']:
         return jsonify(npm_result), 500
     
-    # 缓存 streams 数据供后台线程使用
-    global CACHED_STREAMS
-    CACHED_STREAMS = npm_result['data']
-
+    # 获取本地备注、URL 和健康状态
+    meta = get_all_stream_meta()
     
-    # 获取本地备注和URL
-    memos = get_all_memos()
-    
-    # 合并数据
-    streams = npm_result['data']
+    # 合并数据（复制一份，不修改缓存中的原始数据）
+    streams = [dict(stream) for stream in npm_result['data']]
     for stream in streams:
-        stream_data = memos.get(stream['id'], {})
-        stream['memo'] = stream_data.get('memo', '') if isinstance(stream_data, dict) else ''
-        stream['doc_url'] = stream_data.get('doc_url', '') if isinstance(stream_data, dict) else ''
-        stream['test_url'] = stream_data.get('test_url', '') if isinstance(stream_data, dict) else ''
-        stream['repo_url'] = stream_data.get('repo_url', '') if isinstance(stream_data, dict) else ''
-        
-        # 从数据库读取健康状态（而非内存）
-        health = get_health_status(stream['id'])
-        stream['health_status'] = health['status']
-        stream['health_msg'] = health['msg']
+        stream.update(meta.get(stream['id'], _EMPTY_META))
 
-    
-    return jsonify({"success": True, "data": streams})
+    # 带上 ETag，前端轮询时数据未变化直接返回 304，省去响应体传输和前端重新渲染
+    response = jsonify({"success": True, "data": streams})
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 @app.route('/api/streams', methods=['POST'])
@@ -575,59 +1189,45 @@ def api_create_stream():
         token = session.get('token')
         data = request.json
 
-        print(f"📥 收到前端数据: {data}")
+        logger.debug("📥 收到前端数据: %s", data)
 
-        incoming_port = data.get('incoming_port')
-        forward_ip = data.get('forward_ip')
-        forward_port = data.get('forward_port')
+        # 验证参数
+        try:
+            incoming_port, forward_ip, forward_port = parse_stream_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         memo = data.get('memo', '')
         doc_url = data.get('doc_url', '')
         test_url = data.get('test_url', '')
         repo_url = data.get('repo_url', '')
 
-        # 验证参数
-        if not all([incoming_port, forward_ip, forward_port]):
-            return jsonify({"success": False, "error": "参数不完整"}), 400
-
-        # 验证端口范围
-        incoming_port = int(incoming_port)
-        forward_port = int(forward_port)
-        if not (1 <= incoming_port <= 65535) or not (1 <= forward_port <= 65535):
-            return jsonify({"success": False, "error": "端口号必须在 1-65535 之间"}), 400
-
         # 🔒 端口冲突验证：检查入站端口是否已被占用
-        existing_streams = npm_get_streams(token)
+        existing_streams = get_streams_cached(token)
         if existing_streams['success']:
-            for stream in existing_streams['data']:
-                if stream['incoming_port'] == incoming_port:
-                    return jsonify({
-                        "success": False, 
-                        "error": f"入站端口 {incoming_port} 已被占用（ID: {stream['id']}），请使用其他端口"
-                    }), 409  # 409 Conflict
+            owner_id = existing_streams['by_port'].get(incoming_port)
+            if owner_id is not None:
+                return jsonify({
+                    "success": False, 
+                    "error": f"入站端口 {incoming_port} 已被占用（ID: {owner_id}），请使用其他端口"
+                }), 409  # 409 Conflict
 
         # 调用 NPM 创建
         result = npm_create_stream(token, incoming_port, forward_ip, forward_port)
 
         if result['success']:
             npm_id = result['data']['id']
+            invalidate_streams_cache()
             save_memo(npm_id, memo, doc_url, test_url, repo_url)
             
             # 🔥 立即检查健康状态
-            import threading
-            threading.Thread(
-                target=check_single_stream_health,
-                args=(npm_id, forward_ip, forward_port),
-                daemon=True
-            ).start()
+            HEALTH_POOL.submit(check_single_stream_health, npm_id, forward_ip, forward_port)
             
             return jsonify({"success": True, "message": "创建成功", "data": result['data']})
         else:
             return jsonify(result), 500
 
     except Exception as e:
-        print(f"❌ 创建转发异常: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 创建转发异常: %s", e)
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"}), 500
 
 
@@ -637,22 +1237,59 @@ def api_delete_stream(stream_id):
     """删除端口转发"""
     token = session.get('token')
 
-    print(f"📝 收到删除请求: stream_id={stream_id}")
+    logger.debug("📝 收到删除请求: stream_id=%s", stream_id)
 
     # 先调用 NPM 删除
     result = npm_delete_stream(token, stream_id)
 
     if result['success']:
         # NPM 删除成功，再删除本地备注
+        invalidate_streams_cache()
         delete_memo(stream_id)
-        print(f"✅ 删除成功: stream_id={stream_id}")
+        logger.info("✅ 删除成功: stream_id=%s", stream_id)
         return jsonify({"success": True, "message": "删除成功"})
     else:
         # NPM 删除失败，返回具体错误
-        print(f"❌ 删除失败: {result['error']}")
+        logger.error("❌ 删除失败: %s", result['error'])
         return jsonify(result), 500
 
 
+@app.route('/api/streams/batch-delete', methods=['POST'])
+@login_required
+def api_batch_delete_streams():
+    """批量删除端口转发（并发请求 NPM）"""
+    token = session.get('token')
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+
+    # type() 而非 isinstance：排除 true/false（bool 是 int 的子类）
+    if not ids or not isinstance(ids, list) or not all(type(i) is int for i in ids):
+        return jsonify({"success": False, "error": "参数不完整"}), 400
+
+    logger.debug("📝 收到批量删除请求: ids=%s", ids)
+
+    results = npm_map(npm_delete_stream, token, ids)
+    deleted = [sid for sid, res in results.items() if res['success']]
+    failed = {sid: res['error'] for sid, res in results.items() if not res['success']}
+
+    # NPM 删除成功的再删除本地备注
+    if deleted:
+        invalidate_streams_cache()
+        delete_memos_bulk(deleted)
+
+    if failed:
+        logger.error("❌ 批量删除部分失败: %s", failed)
+        return jsonify({
+            "success": False,
+            "error": f"{len(failed)} 条规则删除失败",
+            "deleted": deleted,
+            "failed": failed
+        }), 500
+
+    logger.info("✅ 批量删除成功: ids=%s", deleted)
+    return jsonify({"success": True, "message": "删除成功", "deleted": deleted})
+
+
 @app.route('/api/streams/<int:stream_id>', methods=['PUT'])
 @login_required
 def api_update_stream(stream_id):
@@ -661,59 +1298,45 @@ def api_update_stream(stream_id):
         token = session.get('token')
         data = request.json
 
-        print(f"📝 收到编辑请求: stream_id={stream_id}, data={data}")
+        logger.debug("📝 收到编辑请求: stream_id=%s, data=%s", stream_id, data)
 
-        incoming_port = data.get('incoming_port')
-        forward_ip = data.get('forward_ip')
-        forward_port = data.get('forward_port')
+        # 验证参数
+        try:
+            incoming_port, forward_ip, forward_port = parse_stream_params(data)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         memo = data.get('memo', '')
         doc_url = data.get('doc_url', '')
         test_url = data.get('test_url', '')
         repo_url = data.get('repo_url', '')
 
-        # 验证参数
-        if not all([incoming_port, forward_ip, forward_port]):
-            return jsonify({"success": False, "error": "参数不完整"}), 400
-
-        # 验证端口范围
-        incoming_port = int(incoming_port)
-        forward_port = int(forward_port)
-        if not (1 <= incoming_port <= 65535) or not (1 <= forward_port <= 65535):
-            return jsonify({"success": False, "error": "端口号必须在 1-65535 之间"}), 400
-
         # 🔒 端口冲突验证：检查入站端口是否被其他规则占用（排除自身）
-        existing_streams = npm_get_streams(token)
+        existing_streams = get_streams_cached(token)
         if existing_streams['success']:
-            for stream in existing_streams['data']:
-                if stream['incoming_port'] == incoming_port and stream['id'] != stream_id:
-                    return jsonify({
-                        "success": False,
-                        "error": f"入站端口 {incoming_port} 已被其他规则占用（ID: {stream['id']}）"
-                    }), 409
+            owner_id = existing_streams['by_port'].get(incoming_port)
+            if owner_id is not None and owner_id != stream_id:
+                return jsonify({
+                    "success": False,
+                    "error": f"入站端口 {incoming_port} 已被其他规则占用（ID: {owner_id}）"
+                }), 409
 
         # 调用 NPM 更新
         result = npm_update_stream(token, stream_id, incoming_port, forward_ip, forward_port)
 
         if result['success']:
+            invalidate_streams_cache()
             # 更新本地备注
             save_memo(stream_id, memo, doc_url, test_url, repo_url)
             
             # 🔥 立即检查健康状态
-            import threading
-            threading.Thread(
-                target=check_single_stream_health,
-                args=(stream_id, forward_ip, forward_port),
-                daemon=True
-            ).start()
+            HEALTH_POOL.submit(check_single_stream_health, stream_id, forward_ip, forward_port)
             
             return jsonify({"success": True, "message": "更新成功", "data": result['data']})
         else:
             return jsonify(result), 500
 
     except Exception as e:
-        print(f"❌ 更新转发异常: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 更新转发异常: %s", e)
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"}), 500
 
 
@@ -726,36 +1349,108 @@ def api_toggle_stream(stream_id):
         data = request.json
         enabled = data.get('enabled', True)
 
-        print(f"🔄 切换请求: stream_id={stream_id}, enabled={enabled}")
+        logger.debug("🔄 切换请求: stream_id=%s, enabled=%s", stream_id, enabled)
 
         result = npm_toggle_stream(token, stream_id, enabled)
 
         if result['success']:
+            invalidate_streams_cache()
             return jsonify({"success": True, "message": "状态切换成功", "data": result['data']})
         else:
             return jsonify(result), 500
 
     except Exception as e:
-        print(f"❌ 切换状态异常: {str(e)}")
+        logger.exception("❌ 切换状态异常: %s", e)
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"}), 500
 
 
 # ==================== 主程序入口 ====================
+_BACKGROUND_STARTED = False
+_DAEMON_LOCK_FD = None  # 当选 worker 持有的锁，进程存活期间不释放
+
+
+def start_background_services():
+    """
+    初始化数据库、预编译模板并启动健康检查守护线程（每个进程只执行一次）
+    多 worker 部署时每个 worker 各自建立数据库连接池，
+    但只有抢到 _DAEMON_LOCK_FILE 的 worker 运行健康检查
+    """
+    global _BACKGROUND_STARTED, _DAEMON_LOCK_FD
+    if _BACKGROUND_STARTED:
+        return
+    _BACKGROUND_STARTED = True
+
+    # 初始化数据库（迁移只能由一个进程执行）
+    fd = lock_file(_INIT_LOCK_FILE)
+    try:
+        init_db()
+    finally:
+        unlock_file(fd)
+    # 预编译模板，首个请求无需解析模板
+    warm_templates()
+
+    _DAEMON_LOCK_FD = lock_file(_DAEMON_LOCK_FILE, blocking=False)
+    if _DAEMON_LOCK_FD is None:
+        # 落选的 worker 待命：原持有者退出（如 gunicorn HUP 重载时旧 worker 退出）后接管
+        logger.info("⏭️ 健康检查已由其他 worker 运行，本进程待命 (pid=%s)", os.getpid())
+        threading.Thread(target=standby_health_daemon, daemon=True).start()
+        return
+
+    # 启动后台健康检查线程
+    t = threading.Thread(target=health_check_daemon, args=(app,), daemon=True)
+    t.start()
+    logger.info("🩺 健康检查守护线程已启动 (pid=%s)", os.getpid())
+
+
+def standby_health_daemon():
+    """待命线程：阻塞等待健康检查锁，拿到后在本线程内运行健康检查"""
+    global _DAEMON_LOCK_FD
+    _DAEMON_LOCK_FD = lock_file(_DAEMON_LOCK_FILE)
+    logger.info("🩺 接管健康检查 (pid=%s)", os.getpid())
+    health_check_daemon(app)
+
+
+def exec_gunicorn():
+    """以 gunicorn (gthread) 替换当前进程，当前解释器未安装 gunicorn 时返回"""
+    # 只认当前解释器（如 venv）中的 gunicorn，PATH 上其他环境的 gunicorn 可能导入不了 flask
+    if importlib.util.find_spec("gunicorn") is None:
+        return
+    print(f"🧵 使用 gunicorn 多进程服务 (workers={WEB_WORKERS}, threads={WEB_THREADS})")
+    # 不切换工作目录：数据库、密钥等相对路径与 waitress / Flask 服务器保持一致
+    os.execv(sys.executable, [
+        sys.executable, "-m", "gunicorn", "-b", f"0.0.0.0:{PORT}",
+        "--pythonpath", os.path.dirname(os.path.abspath(__file__)),
+        "-w", str(WEB_WORKERS), "-k", "gthread", "--threads", str(WEB_THREADS),
+        "app:app",
+    ])
+
+
 if __name__ == '__main__':
-    # 初始化数据库
-    init_db()
-    
     print("=" * 60)
     print("🚀 NPM Meta - Nginx Proxy Manager 增强管理工具")
-    print(f"📍 访问地址: http://127.0.0.1:5001")
+    print(f"📍 访问地址: http://127.0.0.1:{PORT}")
     print(f"🔗 NPM 服务器: {NPM_HOST}")
     print("=" * 60)
-    
-    # 启动后台健康检查线程
-    t = threading.Thread(target=health_check_daemon, args=(app,), daemon=True)
-    t.start()
-    
-    # 启动 Flask 应用
-    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=6789)
 
+    # 非调试模式优先交给 gunicorn，由各 worker 导入本模块时自行初始化
+    if not DEBUG:
+        exec_gunicorn()
 
+    start_background_services()
+
+    # 未安装 gunicorn 时使用 waitress 多线程服务，FLASK_DEBUG=1 时使用开发服务器
+    serve = None
+    if not DEBUG:
+        try:
+            from waitress import serve
+        except ImportError:
+            pass  # waitress 未安装时使用 Flask 自带服务器
+
+    if serve:
+        print(f"🧵 使用 waitress 多线程服务 (threads={WEB_THREADS})")
+        serve(app, host='0.0.0.0', port=PORT, threads=WEB_THREADS)
+    else:
+        app.run(debug=DEBUG, use_reloader=False, threaded=True, host='0.0.0.0', port=PORT)
+else:
+    # 被 WSGI 服务器（gunicorn / waitress-serve 等）导入时在 worker 内完成初始化
+    start_background_services()